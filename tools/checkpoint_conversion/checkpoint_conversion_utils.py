@@ -5,11 +5,8 @@ import zipfile
 
 
 def get_md5_checksum(file_path):
-    md5_hash = hashlib.md5()
     with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            md5_hash.update(byte_block)
-    return md5_hash.hexdigest()
+        return hashlib.file_digest(f, "md5").hexdigest()
 
 
 def _is_within_directory(directory, target):
@@ -1,12 +1,19 @@
+import gc
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
+import keras
 import numpy as np
 import requests
 import tensorflow as tf
+import torch
 import transformers
 from absl import app
 from absl import flags
+from requests.adapters import HTTPAdapter
+from safetensors import safe_open
+from urllib3.util import Retry
 
 import keras_hub
 from tools.checkpoint_conversion.checkpoint_conversion_utils import (
@@ -21,39 +28,85 @@ PRESET_MAP = {
 
 EXTRACT_DIR = "./{}"
 
+# Pairs of `(KerasHub config key, HF config key)`.
+CONFIG_KEY_MAP = (
+    ("vocabulary_size", "vocab_size"),
+    ("num_layers", "n_layers"),
+    ("num_heads", "n_heads"),
+    ("hidden_dim", "dim"),
+    ("intermediate_dim", "hidden_dim"),
+    ("dropout", "dropout"),
+    ("max_sequence_length", "max_position_embeddings"),
+)
+
+SAMPLE_TEXT = ["cricket is awesome, easily the best sport in the world!"]
+
+DOWNLOAD_CHUNK_SIZE = 4 << 20  # 4 MiB.
+
+# All downloads share one connection pool, so the TLS handshake with the
+# hub is paid once per host.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=4,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    ),
+)
+
 FLAGS = flags.FLAGS
 flags.DEFINE_string(
-    "preset", None, f"Must be one of {','.join(PRESET_MAP.keys())}"
+    "preset",
+    None,
+    f"Must be one of {','.join(PRESET_MAP.keys())}, or `all` to convert "
+    "every preset in a single process.",
 )
 
 
-def download_files(hf_model_name):
-    print("-> Download original vocab and config.")
+def download_file(url, path):
+    if os.path.exists(path):
+        print(f"`{path}` already exists, skipping the download.")
+        return
 
-    extract_dir = EXTRACT_DIR.format(FLAGS.preset)
-    if not os.path.exists(extract_dir):
-        os.makedirs(extract_dir)
+    # Stream the response straight to disk instead of buffering it in memory.
+    # The body goes to a temporary file that only replaces `path` once it is
+    # complete, so a failed download never leaves a truncated file behind.
+    tmp_path = f"{path}.tmp"
+    with SESSION.get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(tmp_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+    os.replace(tmp_path, path)
+    print(f"`{path}`")
 
-    # Config.
-    config_path = os.path.join(extract_dir, "config.json")
-    response = requests.get(
-        f"https://huggingface.co/{hf_model_name}/raw/main/config.json"
-    )
-    open(config_path, "wb").write(response.content)
-    print(f"`{config_path}`")
 
-    # Vocab.
-    vocab_path = os.path.join(extract_dir, "vocab.txt")
-    response = requests.get(
-        f"https://huggingface.co/{hf_model_name}/raw/main/vocab.txt"
-    )
-    open(vocab_path, "wb").write(response.content)
-    print(f"`{vocab_path}`")
+def download_files(preset, hf_model_name):
+    print("-> Download original vocab, config and weights.")
 
+    extract_dir = EXTRACT_DIR.format(preset)
+    if not os.path.exists(extract_dir):
+        os.makedirs(extract_dir)
 
-def define_preprocessor(hf_model_name):
+    base_url = f"https://huggingface.co/{hf_model_name}"
+    urls = [
+        f"{base_url}/raw/main/config.json",
+        f"{base_url}/raw/main/vocab.txt",
+        f"{base_url}/resolve/main/model.safetensors",
+    ]
+    paths = [
+        os.path.join(extract_dir, "config.json"),
+        os.path.join(extract_dir, "vocab.txt"),
+        os.path.join(extract_dir, "model.safetensors"),
+    ]
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        list(executor.map(download_file, urls, paths))
+
+
+def define_preprocessor(preset, hf_model_name):
     print("\n-> Define the tokenizers.")
-    extract_dir = EXTRACT_DIR.format(FLAGS.preset)
+    extract_dir = EXTRACT_DIR.format(preset)
     vocab_path = os.path.join(extract_dir, "vocab.txt")
 
     keras_hub_tokenizer = keras_hub.models.DistilBertTokenizer(
@@ -73,225 +126,256 @@ def define_preprocessor(hf_model_name):
     return keras_hub_preprocessor, hf_tokenizer
 
 
-def convert_checkpoints(keras_hub_model, hf_model):
+def convert_checkpoints(preset, keras_hub_model):
     print("\n-> Convert original weights to KerasHub format.")
 
-    extract_dir = EXTRACT_DIR.format(FLAGS.preset)
+    extract_dir = EXTRACT_DIR.format(preset)
     config_path = os.path.join(extract_dir, "config.json")
+    weights_path = os.path.join(extract_dir, "model.safetensors")
 
     # Build config.
-    cfg = {}
     with open(config_path, "r") as pt_cfg_handler:
         pt_cfg = json.load(pt_cfg_handler)
-    cfg["vocabulary_size"] = pt_cfg["vocab_size"]
-    cfg["num_layers"] = pt_cfg["n_layers"]
-    cfg["num_heads"] = pt_cfg["n_heads"]
-    cfg["hidden_dim"] = pt_cfg["dim"]
-    cfg["intermediate_dim"] = pt_cfg["hidden_dim"]
-    cfg["dropout"] = pt_cfg["dropout"]
-    cfg["max_sequence_length"] = pt_cfg["max_position_embeddings"]
+    cfg = {key: pt_cfg[hf_key] for key, hf_key in CONFIG_KEY_MAP}
 
     print("Config:", cfg)
 
-    hf_wts = hf_model.state_dict()
-    print("Original weights:")
-    print(
-        str(hf_wts.keys())
-        .replace(", ", "\n")
-        .replace("odict_keys([", "")
-        .replace("]", "")
-        .replace(")", "")
-    )
+    # Tensors are read lazily from the memory-mapped safetensors file.
+    with safe_open(weights_path, framework="np") as hf_wts:
+        print("Original weights:")
+        print("\n".join(hf_wts.keys()))
 
-    keras_hub_model.get_layer(
-        "token_and_position_embedding"
-    ).token_embedding.embeddings.assign(
-        hf_wts["embeddings.word_embeddings.weight"]
-    )
-    keras_hub_model.get_layer(
-        "token_and_position_embedding"
-    ).position_embedding.position_embeddings.assign(
-        hf_wts["embeddings.position_embeddings.weight"]
-    )
+        def get_tensor(key):
+            # The hub checkpoint is a `DistilBertForMaskedLM`, so the backbone
+            # weights live under the `distilbert.` prefix.
+            return hf_wts.get_tensor(f"distilbert.{key}")
 
-    keras_hub_model.get_layer("embeddings_layer_norm").gamma.assign(
-        hf_wts["embeddings.LayerNorm.weight"]
-    )
-    keras_hub_model.get_layer("embeddings_layer_norm").beta.assign(
-        hf_wts["embeddings.LayerNorm.bias"]
-    )
+        def get_transposed_tensor(key, shape):
+            # Transpose into a single contiguous buffer, so the reshape is a
+            # view.
+            return np.ascontiguousarray(get_tensor(key).T).reshape(shape)
 
-    for i in range(keras_hub_model.num_layers):
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._self_attention_layer._query_dense.kernel.assign(
-            hf_wts[f"transformer.layer.{i}.attention.q_lin.weight"]
-            .transpose(1, 0)
-            .reshape((cfg["hidden_dim"], cfg["num_heads"], -1))
-            .numpy()
+        embeddings_layer = keras_hub_model.get_layer(
+            "token_and_position_embedding"
         )
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._self_attention_layer._query_dense.bias.assign(
-            hf_wts[f"transformer.layer.{i}.attention.q_lin.bias"]
-            .reshape((cfg["num_heads"], -1))
-            .numpy()
+        embeddings_layer.token_embedding.embeddings.assign(
+            get_tensor("embeddings.word_embeddings.weight")
         )
-
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._self_attention_layer._key_dense.kernel.assign(
-            hf_wts[f"transformer.layer.{i}.attention.k_lin.weight"]
-            .transpose(1, 0)
-            .reshape((cfg["hidden_dim"], cfg["num_heads"], -1))
-            .numpy()
-        )
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._self_attention_layer._key_dense.bias.assign(
-            hf_wts[f"transformer.layer.{i}.attention.k_lin.bias"]
-            .reshape((cfg["num_heads"], -1))
-            .numpy()
+        embeddings_layer.position_embedding.position_embeddings.assign(
+            get_tensor("embeddings.position_embeddings.weight")
         )
 
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._self_attention_layer._value_dense.kernel.assign(
-            hf_wts[f"transformer.layer.{i}.attention.v_lin.weight"]
-            .transpose(1, 0)
-            .reshape((cfg["hidden_dim"], cfg["num_heads"], -1))
-            .numpy()
-        )
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._self_attention_layer._value_dense.bias.assign(
-            hf_wts[f"transformer.layer.{i}.attention.v_lin.bias"]
-            .reshape((cfg["num_heads"], -1))
-            .numpy()
+        embeddings_layer_norm = keras_hub_model.get_layer(
+            "embeddings_layer_norm"
         )
-
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._self_attention_layer._output_dense.kernel.assign(
-            hf_wts[f"transformer.layer.{i}.attention.out_lin.weight"]
-            .transpose(1, 0)
-            .reshape((cfg["num_heads"], -1, cfg["hidden_dim"]))
-            .numpy()
+        embeddings_layer_norm.gamma.assign(
+            get_tensor("embeddings.LayerNorm.weight")
         )
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._self_attention_layer._output_dense.bias.assign(
-            hf_wts[f"transformer.layer.{i}.attention.out_lin.bias"].numpy()
+        embeddings_layer_norm.beta.assign(
+            get_tensor("embeddings.LayerNorm.bias")
         )
 
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._self_attention_layer_norm.gamma.assign(
-            hf_wts[f"transformer.layer.{i}.sa_layer_norm.weight"].numpy()
-        )
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._self_attention_layer_norm.beta.assign(
-            hf_wts[f"transformer.layer.{i}.sa_layer_norm.bias"].numpy()
-        )
+        for i in range(keras_hub_model.num_layers):
+            layer = keras_hub_model.get_layer(f"transformer_layer_{i}")
+            attention_layer = layer._self_attention_layer
+            attention_layer_norm = layer._self_attention_layer_norm
+            intermediate_dense = layer._feedforward_intermediate_dense
+            output_dense = layer._feedforward_output_dense
+            output_layer_norm = layer._feedforward_layer_norm
+
+            attention_layer._query_dense.kernel.assign(
+                get_transposed_tensor(
+                    f"transformer.layer.{i}.attention.q_lin.weight",
+                    (cfg["hidden_dim"], cfg["num_heads"], -1),
+                )
+            )
+            attention_layer._query_dense.bias.assign(
+                get_tensor(
+                    f"transformer.layer.{i}.attention.q_lin.bias"
+                ).reshape((cfg["num_heads"], -1))
+            )
+
+            attention_layer._key_dense.kernel.assign(
+                get_transposed_tensor(
+                    f"transformer.layer.{i}.attention.k_lin.weight",
+                    (cfg["hidden_dim"], cfg["num_heads"], -1),
+                )
+            )
+            attention_layer._key_dense.bias.assign(
+                get_tensor(
+                    f"transformer.layer.{i}.attention.k_lin.bias"
+                ).reshape((cfg["num_heads"], -1))
+            )
+
+            attention_layer._value_dense.kernel.assign(
+                get_transposed_tensor(
+                    f"transformer.layer.{i}.attention.v_lin.weight",
+                    (cfg["hidden_dim"], cfg["num_heads"], -1),
+                )
+            )
+            attention_layer._value_dense.bias.assign(
+                get_tensor(
+                    f"transformer.layer.{i}.attention.v_lin.bias"
+                ).reshape((cfg["num_heads"], -1))
+            )
+
+            attention_layer._output_dense.kernel.assign(
+                get_transposed_tensor(
+                    f"transformer.layer.{i}.attention.out_lin.weight",
+                    (cfg["num_heads"], -1, cfg["hidden_dim"]),
+                )
+            )
+            attention_layer._output_dense.bias.assign(
+                get_tensor(f"transformer.layer.{i}.attention.out_lin.bias")
+            )
+
+            attention_layer_norm.gamma.assign(
+                get_tensor(f"transformer.layer.{i}.sa_layer_norm.weight")
+            )
+            attention_layer_norm.beta.assign(
+                get_tensor(f"transformer.layer.{i}.sa_layer_norm.bias")
+            )
+
+            intermediate_dense.kernel.assign(
+                get_tensor(f"transformer.layer.{i}.ffn.lin1.weight").T
+            )
+            intermediate_dense.bias.assign(
+                get_tensor(f"transformer.layer.{i}.ffn.lin1.bias")
+            )
+
+            output_dense.kernel.assign(
+                get_tensor(f"transformer.layer.{i}.ffn.lin2.weight").T
+            )
+            output_dense.bias.assign(
+                get_tensor(f"transformer.layer.{i}.ffn.lin2.bias")
+            )
+
+            output_layer_norm.gamma.assign(
+                get_tensor(f"transformer.layer.{i}.output_layer_norm.weight")
+            )
+            output_layer_norm.beta.assign(
+                get_tensor(f"transformer.layer.{i}.output_layer_norm.bias")
+            )
 
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._feedforward_intermediate_dense.kernel.assign(
-            hf_wts[f"transformer.layer.{i}.ffn.lin1.weight"]
-            .transpose(1, 0)
-            .numpy()
-        )
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._feedforward_intermediate_dense.bias.assign(
-            hf_wts[f"transformer.layer.{i}.ffn.lin1.bias"].numpy()
-        )
+    # Save the model.
+    print(f"\n-> Save KerasHub model weights to `{preset}.weights.h5`.")
+    keras_hub_model.save_weights(f"{preset}.weights.h5")
 
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._feedforward_output_dense.kernel.assign(
-            hf_wts[f"transformer.layer.{i}.ffn.lin2.weight"]
-            .transpose(1, 0)
-            .numpy()
-        )
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._feedforward_output_dense.bias.assign(
-            hf_wts[f"transformer.layer.{i}.ffn.lin2.bias"].numpy()
-        )
+    return keras_hub_model
 
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._feedforward_layer_norm.gamma.assign(
-            hf_wts[f"transformer.layer.{i}.output_layer_norm.weight"].numpy()
-        )
-        keras_hub_model.get_layer(
-            f"transformer_layer_{i}"
-        )._feedforward_layer_norm.beta.assign(
-            hf_wts[f"transformer.layer.{i}.output_layer_norm.bias"].numpy()
-        )
 
-    # Save the model.
-    print(f"\n-> Save KerasHub model weights to `{FLAGS.preset}.h5`.")
-    keras_hub_model.save_weights(f"{FLAGS.preset}.h5")
+def load_hf_model(preset):
+    print("\n-> Load HF model.")
+    extract_dir = EXTRACT_DIR.format(preset)
+    weights_path = os.path.join(extract_dir, "model.safetensors")
+
+    # Build the model on the meta device to skip random init, then assign the
+    # downloaded checkpoint tensors in place.
+    hf_config = transformers.AutoConfig.from_pretrained(extract_dir)
+    with torch.device("meta"):
+        hf_model = transformers.AutoModel.from_config(hf_config)
+    with safe_open(weights_path, framework="pt") as hf_wts:
+        state_dict = {
+            key: hf_wts.get_tensor(f"distilbert.{key}")
+            for key in hf_model.state_dict().keys()
+        }
+    hf_model.load_state_dict(state_dict, assign=True)
+
+    # `position_ids` is a non-persistent buffer, so it is not part of the
+    # checkpoint and still lives on the meta device.
+    hf_model.embeddings.position_ids = torch.arange(
+        hf_config.max_position_embeddings
+    ).expand((1, -1))
 
-    return keras_hub_model
+    hf_model.eval()
+    return hf_model
+
+
+def get_hf_output(hf_tokenizer, hf_model):
+    print("\n-> Compute the HF reference output.")
+    hf_inputs = hf_tokenizer(
+        SAMPLE_TEXT, padding="max_length", return_tensors="pt"
+    )
+    with torch.inference_mode():
+        hf_output = hf_model(**hf_inputs).last_hidden_state
+    return hf_output.numpy()
+
+
+def get_forward_fn(keras_hub_model):
+    def forward(inputs):
+        return keras_hub_model(inputs, training=False)
+
+    # `tf.function` can only trace the model on the TensorFlow backend.
+    if keras.config.backend() == "tensorflow":
+        forward = tf.function(forward, jit_compile=True)
+    return forward
 
 
 def check_output(
+    preset,
     keras_hub_preprocessor,
     keras_hub_model,
-    hf_tokenizer,
-    hf_model,
+    hf_output,
 ):
     print("\n-> Check the outputs.")
-    sample_text = ["cricket is awesome, easily the best sport in the world!"]
-
-    # KerasHub
-    keras_hub_inputs = keras_hub_preprocessor(tf.constant(sample_text))
-    keras_hub_output = keras_hub_model.predict(keras_hub_inputs)
-
-    # HF
-    hf_inputs = hf_tokenizer(
-        sample_text, padding="max_length", return_tensors="pt"
-    )
-    hf_output = hf_model(**hf_inputs).last_hidden_state
+    keras_hub_inputs = keras_hub_preprocessor(tf.constant(SAMPLE_TEXT))
+    forward = get_forward_fn(keras_hub_model)
+    keras_hub_output = keras.ops.convert_to_numpy(forward(keras_hub_inputs))
 
     print("KerasHub output:", keras_hub_output[0, 0, :10])
     print("HF output:", hf_output[0, 0, :10])
-    print("Difference:", np.mean(keras_hub_output - hf_output.detach().numpy()))
+    print("Difference:", np.mean(keras_hub_output - hf_output))
 
     # Show the MD5 checksum of the model weights.
-    print("Model md5sum: ", get_md5_checksum(f"./{FLAGS.preset}.h5"))
+    print("Model md5sum: ", get_md5_checksum(f"./{preset}.weights.h5"))
 
 
-def main(_):
-    hf_model_name = PRESET_MAP[FLAGS.preset]
+def convert_preset(preset):
+    hf_model_name = PRESET_MAP[preset]
+
+    download_files(preset, hf_model_name)
+
+    keras_hub_preprocessor, hf_tokenizer = define_preprocessor(
+        preset, hf_model_name
+    )
 
-    download_files(hf_model_name)
+    hf_model = load_hf_model(preset)
 
-    keras_hub_preprocessor, hf_tokenizer = define_preprocessor(hf_model_name)
+    # Only the reference output is needed from the HF model, so free it
+    # before the KerasHub model is built.
+    hf_output = get_hf_output(hf_tokenizer, hf_model)
+    del hf_model
+    gc.collect()
 
     print("\n-> Load KerasHub model.")
     keras_hub_model = keras_hub.models.DistilBertBackbone.from_preset(
-        FLAGS.preset, load_weights=False
+        preset, load_weights=False
     )
 
-    print("\n-> Load HF model.")
-    hf_model = transformers.AutoModel.from_pretrained(hf_model_name)
-    hf_model.eval()
-
-    keras_hub_model = convert_checkpoints(keras_hub_model, hf_model)
+    keras_hub_model = convert_checkpoints(preset, keras_hub_model)
 
     check_output(
+        preset,
         keras_hub_preprocessor,
         keras_hub_model,
-        hf_tokenizer,
-        hf_model,
+        hf_output,
     )
 
 
+def main(_):
+    if FLAGS.preset == "all":
+        presets = list(PRESET_MAP.keys())
+    else:
+        presets = [FLAGS.preset]
+
+    for preset in presets:
+        print(f"\n=> Convert `{preset}`.")
+        convert_preset(preset)
+        # Drop the Keras state of the previous preset before the next one.
+        keras.backend.clear_session()
+        gc.collect()
+
+
 if __name__ == "__main__":
     flags.mark_flag_as_required("preset")
     app.run(main)